@@ -1,12 +1,11 @@
 
-import tkinter, tkmacosx, yaml, logging, os, dataclasses, pygame, pdb, tempfile, pyaudio, threading, wave, numpy
+import tkinter, tkmacosx, yaml, logging, os, dataclasses, pygame, pdb, tempfile, pyaudio, threading, wave, numpy, math, queue, time, collections, hashlib
 
 from typing import Any, NoReturn, Callable
 from tkinter import messagebox
 from abc import ABC, abstractmethod
 
 from tkinter import font as tkfont
-from pygame._sdl2.audio import get_audio_device_names
     
 from pynput.keyboard import HotKey, Listener
 
@@ -17,6 +16,15 @@ program_config_home = f"{user_home_config}/soundboard"
 media_path = "./media/"
 sound_path = f"{program_config_home}/audio"
 max_sounds_at_once = 5
+max_sound_seconds = 60
+
+# Audio clock. All scheduling is done in sample frames at this rate.
+sample_rate = 44100
+channel_count = 2
+block_frames = 1024
+
+bytes_per_mb = 1024 * 1024
+cache_path = f"{temp_directory}/soundboard-cache" # Large clips are streamed from here
 
 # Check configuration exists
 if not os.path.exists(user_home_config):
@@ -31,7 +39,6 @@ if not os.path.exists(sound_path):
 # Setup logging
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.DEBUG)
-pygame.mixer.init()
 
 file_handler = logging.FileHandler(f"{program_config_home}/dj_soundboard.log", mode="w+")
 file_handler.setLevel(logging.DEBUG)
@@ -52,6 +59,14 @@ class SoundboardConfig:
     default_volume: float
     default_font_size: int
     app_font: str
+    bpm: float
+    quantize_triggers: bool
+    output_buses: dict[str, dict[str, Any]]
+    default_route: dict[str, float]
+    clip_routes: dict[str, dict[str, float]]
+    max_drift_ms: float
+    memory_budget_mb: float
+    stream_threshold_mb: float
 
 class AppResources:
     warning_image = "why.png"
@@ -66,7 +81,15 @@ def get_and_gen_yaml() -> dict[str, Any]:
         "buttons_per_row": 5,
         "default_volume": 25,
         "default_font_size": 18,
-        "app_font": "DINAlternate-Bold"
+        "app_font": "DINAlternate-Bold",
+        "bpm": 120,
+        "quantize_triggers": False, # Start triggered sounds on the next beat
+        "output_buses": {"main": {"device": None, "gain": 1.0}}, # device: None (Selected in app), output device name, "file:<path>" or "dummy"
+        "default_route": {"main": 1.0}, # Bus name -> gain, for every sound without an entry in `clip_routes`
+        "clip_routes": {}, # Sound file name -> {bus name -> gain}
+        "max_drift_ms": 50, # How far secondary outputs may fall behind the first before they skip ahead
+        "memory_budget_mb": 256, # Decoded clips and recordings. Least recently played clips are evicted or streamed from disk past this
+        "stream_threshold_mb": 4 # Clips larger than this (Decoded) are always streamed from disk
     }
     
     try:
@@ -84,10 +107,12 @@ def get_and_gen_yaml() -> dict[str, Any]:
                 yaml_config = yaml.safe_load(yaml_config_file)
                 if yaml_config:
                     
-                    # Check if yaml file is valid and has all keys
+                    # Fill in keys added since the file was written, keeping the user's values
                     if not set(default_config).issubset(set(yaml_config)):
-                        os.remove(configuration_file)
-                        return get_and_gen_yaml()
+                        yaml_config = default_config | yaml_config
+                        with open(configuration_file, "w+") as write_config:
+                            yaml.dump(yaml_config, write_config)
+                            logger.info("Added missing keys to configuration.")
                     
                     return yaml_config
                 else:
@@ -101,6 +126,16 @@ def get_and_gen_yaml() -> dict[str, Any]:
         logger.error(f"Panik! cannot delete or cannot find config file. ({configuration_file}) returning default.")   
         return default_config
 
+def validate_routes(config: SoundboardConfig) -> None:
+    # Catches typos in bus names once at startup, rather than on every play
+    if not config.output_buses:
+        raise SoundboardError("`output_buses` needs at least one bus.")
+    
+    routes = [("default_route", config.default_route)] + [(f'clip_routes "{name}"', route) for name, route in config.clip_routes.items()]
+    for where, route in routes:
+        if unknown_buses := set(route) - set(config.output_buses):
+            raise SoundboardError(f"{where} uses unknown output buses: {", ".join(sorted(unknown_buses))}")
+
 def rgb_to_hex(r: int, g: int, b: int):
     def _b10_to_hex_color(r: int, g: int, b: int) -> str:
         return f"#{hex(r)[2:]}{hex(g)[2:]}{hex(b)[2:]}"
@@ -110,6 +145,29 @@ def rgb_to_hex(r: int, g: int, b: int):
     r = b if b <= 255 else 255
     return _b10_to_hex_color(r, g, b).upper().ljust(7, "0")
 
+def init_decoder() -> None:
+    # The mixer is only used for decoding, playback goes through `SoundboardRouter`. So it never needs a real audio device,
+    # and it must decode at exactly the rate and channel count the scheduler plays at.
+    if not pygame.mixer.get_init():
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+        pygame.mixer.init(frequency=sample_rate, size=-16, channels=channel_count, allowedchanges=0)
+    
+    if pygame.mixer.get_init() != (sample_rate, -16, channel_count):
+        raise SoundboardError(f"Decoder opened as {pygame.mixer.get_init()}, expected {(sample_rate, -16, channel_count)}")
+
+def decode_sound(path: str) -> numpy.ndarray:
+    # Decodes a sound file into int16 frames of shape (frames, channel_count). The array is a view of the decoded sound, not a copy.
+    init_decoder()
+    return pygame.sndarray.samples(pygame.mixer.Sound(file=path))
+
+def write_wave(path: str, pcm: numpy.ndarray, rate: int=sample_rate) -> None:
+    # Writes int16 frames of shape (frames, channels) as a .wav file
+    with wave.open(path, 'wb') as wave_file:
+        wave_file.setnchannels(pcm.shape[1])
+        wave_file.setsampwidth(2)
+        wave_file.setframerate(rate)
+        wave_file.writeframes(numpy.ascontiguousarray(pcm, dtype=numpy.int16))
+
 # Colors
 default_color = rgb_to_hex(255, 255, 255) # White
 default_highlight_color = rgb_to_hex(225, 225, 225) # Slightly darker white
@@ -120,24 +178,34 @@ try:
     config = SoundboardConfig(**get_and_gen_yaml())
     common_kwargs = {"sticky": "nsew", "pady": 2, "padx": 2}
     app_font = (config.app_font, config.default_font_size)
+    validate_routes(config)
 except TypeError:
     print("Outdated configuration.")
     exit(1)
+except SoundboardError as error:
+    print(f"Invalid configuration: {error}")
+    exit(1)
     
 class SoundboardABC(ABC):
     # Soundboard ABC. Basically just for type annotations
     
     def __init__(self) -> None:
         super().__init__()
-        self._old_device: str | None = None
-        self._playing_sounds: list[pygame.mixer.SoundType]  = []
+        self._old_device: int | None = None
+        self._playing_sounds: list[SoundboardClip]  = []
         self._sb_buttons: list[SoundboardButton] = []
 
+        self.memory = SoundboardMemoryAccountant(int(config.memory_budget_mb * bytes_per_mb))
+        self.scheduler = SoundboardScheduler(bpm=config.bpm, buses={name: float(bus.get("gain", 1.0)) for name, bus in config.output_buses.items()})
+        self.clip_cache = SoundboardClipCache(self.memory, int(config.stream_threshold_mb * bytes_per_mb), is_pinned=self.scheduler.is_playing)
+        self.router: SoundboardRouter | None = None
         self.recording_thread: SoundboardRecordingThread | None = None
         self.device_label = None
         self.after_id = None
         self.volume = config.default_volume
+        self.queue_mode = False
         self.input_devices: dict[int, str] = {}
+        self.output_devices: dict[int, str] = {}
         self.font: tkfont.Font
         
     @abstractmethod
@@ -178,40 +246,551 @@ class SoundboardDecorators:
             return func_out
         return _inner
 
+class SoundboardMemoryAccountant:
+    # Tracks bytes of audio held by category. "streamed" audio is memory mapped from disk, so it does not count towards the budget.
+    unbudgeted = ("streamed",)
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.peak = 0
+        self._usage: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def used(self) -> int:
+        with self._lock:
+            return self._used()
+
+    def _used(self) -> int:
+        return sum(nbytes for category, nbytes in self._usage.items() if category not in self.unbudgeted)
+
+    def fits(self, nbytes: int) -> bool:
+        return self.used + nbytes <= self.budget
+
+    def add(self, category: str, nbytes: int) -> None:
+        with self._lock:
+            self._usage[category] = self._usage.get(category, 0) + nbytes
+            self.peak = max(self.peak, self._used())
+
+    def release(self, category: str, nbytes: int) -> None:
+        with self._lock:
+            self._usage[category] = max(self._usage.get(category, 0) - nbytes, 0)
+
+    def usage(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._usage)
+
+    def format_stats(self) -> str:
+        lines = [f"Memory: {self.used / bytes_per_mb:.1f} / {self.budget / bytes_per_mb:.0f} MB (Peak {self.peak / bytes_per_mb:.1f} MB)"]
+        lines.extend(f"  {category}: {nbytes / bytes_per_mb:.1f} MB" for category, nbytes in sorted(self.usage().items()))
+        return "\n".join(lines)
+
+class SoundboardClipCache:
+    # Keeps decoded clips within the memory budget. Least recently played clips are evicted first, clips that are
+    # too large (Or still do not fit after evicting) are written to `cache_path` once and memory mapped from there.
+
+    def __init__(self, accountant: SoundboardMemoryAccountant, stream_threshold: int, is_pinned: Callable[[numpy.ndarray], bool]=lambda pcm: False) -> None:
+        self.accountant = accountant
+        self.stream_threshold = stream_threshold
+        self.is_pinned = is_pinned
+        self._clips: collections.OrderedDict[str, tuple[float, numpy.ndarray]] = collections.OrderedDict() # Path -> (mtime, pcm)
+        self._streamed: dict[str, tuple[float, numpy.ndarray, str]] = {} # Path -> (mtime, memory map, spill file)
+        self._lock = threading.Lock()
+
+    def load(self, path: str) -> numpy.ndarray:
+        mtime = os.path.getmtime(path)
+
+        with self._lock:
+            if (cached := self._clips.get(path)) and cached[0] == mtime:
+                self._clips.move_to_end(path)
+                return cached[1]
+            if (streamed := self._streamed.get(path)) and streamed[0] == mtime:
+                return streamed[1]
+
+            self._forget(path) # Stale, the file changed on disk
+            pcm = decode_sound(path)
+            
+            # Checked before caching, a clip that can never play should not take up memory or a spill file
+            if len(pcm) > max_sound_seconds * sample_rate:
+                raise SoundboardError(f"Soundboard audio cannot be longer than {max_sound_seconds} seconds.")
+
+            if pcm.nbytes > self.stream_threshold or not self._make_room(pcm.nbytes):
+                return self._stream(path, mtime, pcm)
+
+            self._clips[path] = (mtime, pcm)
+            self.accountant.add("clips", pcm.nbytes)
+            return pcm
+
+    def clear(self) -> None:
+        with self._lock:
+            for path in list(self._clips) + list(self._streamed):
+                self._forget(path)
+
+    def make_room(self, nbytes: int) -> bool:
+        # Evicts least recently played clips until `nbytes` more fit in the budget. For anything else that needs memory, like recordings
+        with self._lock:
+            return self._make_room(nbytes)
+
+    def _make_room(self, nbytes: int) -> bool:
+        if nbytes > self.accountant.budget:
+            return False
+
+        for path in list(self._clips):
+            if self.accountant.fits(nbytes):
+                break
+            if not self.is_pinned(self._clips[path][1]): # Evicting a playing clip would not free anything until it ends
+                self._forget(path)
+
+        return self.accountant.fits(nbytes)
+
+    def _stream(self, path: str, mtime: float, pcm: numpy.ndarray) -> numpy.ndarray:
+        os.makedirs(cache_path, exist_ok=True)
+        spill_file = f"{cache_path}/{hashlib.sha1(path.encode()).hexdigest()}.pcm"
+        pcm.tofile(spill_file)
+
+        mapped = numpy.memmap(spill_file, dtype=pcm.dtype, mode="r", shape=pcm.shape)
+        self._streamed[path] = (mtime, mapped, spill_file)
+        self.accountant.add("streamed", pcm.nbytes)
+        logger.debug(f'Streaming "{path}" from disk ({pcm.nbytes / bytes_per_mb:.1f} MB)')
+        return mapped
+
+    def _forget(self, path: str) -> None:
+        if path in self._clips:
+            self.accountant.release("clips", self._clips.pop(path)[1].nbytes)
+
+        if path in self._streamed:
+            _, mapped, spill_file = self._streamed.pop(path)
+            self.accountant.release("streamed", mapped.nbytes)
+            try:
+                os.remove(spill_file)
+            except FileNotFoundError:
+                pass
+
+@dataclasses.dataclass(eq=False)
+class SoundboardClip:
+    name: str
+    pcm: numpy.ndarray
+    start_frame: int
+    routes: dict[str, float] # Bus name -> gain
+    on_end: Callable[["SoundboardClip"], Any] | None = None
+
+    @property
+    def end_frame(self) -> int:
+        return self.start_frame + len(self.pcm)
+
+class SoundboardScheduler:
+    # Mixes scheduled clips against the audio clock (`frame`), which only advances when a block is rendered.
+    # Timing is therefore sample accurate and independent of UI load. Rendering without an output thread is the offline mode.
+    # Every bus is mixed from the same decoded clip buffer, so a clip routed to several buses is never copied.
+
+    def __init__(self, rate: int=sample_rate, channels: int=channel_count, bpm: float=120, buses: dict[str, float] | None=None) -> None:
+        self.rate = rate
+        self.channels = channels
+        self.bpm = bpm
+        self.gain = 1.0
+        self.frame = 0
+        self.buses: dict[str, float] = buses if buses is not None else {"main": 1.0} # Bus name -> gain
+        self._clips: list[SoundboardClip] = []
+        self._lock = threading.RLock()
+
+    @property
+    def frames_per_beat(self) -> float:
+        return self.rate * 60 / self.bpm
+
+    def is_busy(self) -> bool:
+        with self._lock:
+            return bool(self._clips)
+
+    def is_playing(self, pcm: numpy.ndarray) -> bool:
+        with self._lock:
+            return any(clip.pcm is pcm for clip in self._clips)
+
+    def next_beat(self, frame: int | None=None) -> int:
+        # First beat grid frame at or after `frame` (Defaults to now)
+        frame = self.frame if frame is None else frame
+        beat = math.floor(frame / self.frames_per_beat)
+        
+        # Grid frames are rounded, so the beat before the division can still be at or after `frame`
+        if round(beat * self.frames_per_beat) >= frame:
+            return round(beat * self.frames_per_beat)
+        return round((beat + 1) * self.frames_per_beat)
+
+    def schedule(self, name: str, pcm: numpy.ndarray, start_frame: int | None=None, on_end: Callable[[SoundboardClip], Any] | None=None, routes: dict[str, float] | None=None) -> SoundboardClip:
+        if pcm.ndim != 2 or pcm.shape[1] != self.channels:
+            raise SoundboardError(f"Clip \"{name}\" must have shape (frames, {self.channels}), got {pcm.shape}")
+
+        with self._lock:
+            routes = routes if routes is not None else {bus: 1.0 for bus in self.buses}
+            if unknown_buses := set(routes) - set(self.buses):
+                raise SoundboardError(f"Clip \"{name}\" is routed to unknown output buses: {", ".join(sorted(unknown_buses))}")
+
+            # Frames in the past have already been rendered, so late clips start now.
+            clip = SoundboardClip(name, pcm, max(self.frame if start_frame is None else start_frame, self.frame), routes, on_end)
+            self._clips.append(clip)
+            return clip
+
+    def queue(self, name: str, pcm: numpy.ndarray, on_end: Callable[[SoundboardClip], Any] | None=None, routes: dict[str, float] | None=None) -> SoundboardClip:
+        # Starts on the exact frame the last scheduled clip ends, so chained clips play without a gap.
+        with self._lock:
+            return self.schedule(name, pcm, max((clip.end_frame for clip in self._clips), default=self.frame), on_end, routes)
+
+    def sequence(self, clips: list[tuple[str, numpy.ndarray]], start_frame: int | None=None, routes: dict[str, float] | None=None) -> list[SoundboardClip]:
+        # Each clip starts where the previous one in the sequence ends, regardless of anything else that is scheduled
+        with self._lock:
+            scheduled = []
+            for name, pcm in clips:
+                if scheduled:
+                    scheduled.append(self.schedule(name, pcm, scheduled[-1].end_frame, routes=routes))
+                elif start_frame is not None:
+                    scheduled.append(self.schedule(name, pcm, start_frame, routes=routes))
+                else:
+                    scheduled.append(self.queue(name, pcm, routes=routes))
+            return scheduled
+
+    def stop_all(self) -> None:
+        with self._lock:
+            self._clips.clear()
+
+    def render(self, frames: int=block_frames) -> dict[str, numpy.ndarray]:
+        finished: list[SoundboardClip] = []
+
+        with self._lock:
+            mixes = {bus: numpy.zeros((frames, self.channels), dtype=numpy.float32) for bus in self.buses}
+            block_start = self.frame
+            block_end = block_start + frames
+
+            for clip in self._clips:
+                if clip.start_frame >= block_end:
+                    continue
+
+                src = block_start - clip.start_frame if clip.start_frame < block_start else 0
+                dst = clip.start_frame - block_start if clip.start_frame > block_start else 0
+                count = min(len(clip.pcm) - src, frames - dst)
+                if count > 0:
+                    segment = clip.pcm[src:src + count] # View into the shared clip buffer
+                    for bus, gain in clip.routes.items():
+                        if bus in mixes:
+                            mixes[bus][dst:dst + count] += segment if gain == 1.0 else segment * gain
+                if clip.end_frame <= block_end:
+                    finished.append(clip)
+
+            for clip in finished:
+                self._clips.remove(clip)
+            self.frame = block_end
+            for bus, mix in mixes.items():
+                mix *= self.gain * self.buses[bus]
+
+        for clip in finished:
+            if clip.on_end:
+                clip.on_end(clip)
+
+        return {bus: numpy.clip(mix, -32768, 32767).astype(numpy.int16) for bus, mix in mixes.items()}
+
+    def render_offline(self, frames: int) -> dict[str, numpy.ndarray]:
+        # Renders `frames` frames of every bus in the same blocks as live playback, without any audio hardware.
+        blocks = [self.render(min(block_frames, frames - rendered)) for rendered in range(0, frames, block_frames)]
+        return {bus: numpy.concatenate([block[bus] for block in blocks]) if blocks else numpy.zeros((0, self.channels), dtype=numpy.int16) for bus in self.buses}
+
+    def write_to_file(self, path: str, frames: int, bus: str="main") -> None:
+        write_wave(path, self.render_offline(frames)[bus], self.rate)
+
+class SoundboardOutputBackend(ABC):
+    # Somewhere a bus can write blocks to. `write` must block for roughly the duration of the block, like a sound card does.
+
+    def __init__(self, realtime: bool=True) -> None:
+        self.realtime = realtime
+        self.frames_written = 0
+        self._started_at: float | None = None
+        self._rate = sample_rate
+
+    def open(self, rate: int, channels: int) -> None:
+        self._rate = rate
+        self._started_at = time.perf_counter()
+
+    @abstractmethod
+    def write(self, block: numpy.ndarray) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def _pace(self, frames: int) -> None:
+        # Sleeps until the wall clock catches up with the frames written, for backends without a device clock
+        self.frames_written += frames
+        if self.realtime and self._started_at is not None:
+            ahead = self.frames_written / self._rate - (time.perf_counter() - self._started_at)
+            if ahead > 0:
+                time.sleep(ahead)
+
+class SoundboardDeviceOutput(SoundboardOutputBackend):
+    def __init__(self, output_device_index: int | None=None) -> None:
+        super().__init__()
+        self.device = output_device_index
+        self._port_audio: pyaudio.PyAudio | None = None
+        self._stream = None
+
+    def open(self, rate: int, channels: int) -> None:
+        super().open(rate, channels)
+        self._port_audio = pyaudio.PyAudio()
+        self._stream = self._port_audio.open(rate=rate, channels=channels, format=pyaudio.paInt16, frames_per_buffer=block_frames, output=True, output_device_index=self.device)
+
+    def write(self, block: numpy.ndarray) -> None:
+        if self._stream:
+            self._stream.write(block.tobytes())
+            self.frames_written += len(block)
+
+    def close(self) -> None:
+        if self._stream:
+            self._stream.stop_stream()
+            self._stream.close()
+        if self._port_audio:
+            self._port_audio.terminate()
+
+class SoundboardFileOutput(SoundboardOutputBackend):
+    def __init__(self, path: str, realtime: bool=True) -> None:
+        super().__init__(realtime)
+        self.path = path
+        self._wave_file: wave.Wave_write | None = None
+
+    def open(self, rate: int, channels: int) -> None:
+        super().open(rate, channels)
+        self._wave_file = wave.open(self.path, 'wb')
+        self._wave_file.setnchannels(channels)
+        self._wave_file.setsampwidth(2)
+        self._wave_file.setframerate(rate)
+
+    def write(self, block: numpy.ndarray) -> None:
+        if self._wave_file:
+            self._wave_file.writeframes(block.tobytes())
+            self._pace(len(block))
+
+    def close(self) -> None:
+        if self._wave_file:
+            self._wave_file.close()
+
+class SoundboardDummyOutput(SoundboardOutputBackend):
+    # Discards audio (Or keeps it in `blocks` when `capture` is set). Useful without audio hardware.
+
+    def __init__(self, realtime: bool=True, capture: bool=False) -> None:
+        super().__init__(realtime)
+        self.capture = capture
+        self.blocks: list[numpy.ndarray] = []
+
+    def write(self, block: numpy.ndarray) -> None:
+        if self.capture:
+            self.blocks.append(block)
+        self._pace(len(block))
+
+def create_output_backend(device: str | None, selected_device: int | None, output_devices: dict[int, str]) -> SoundboardOutputBackend:
+    # `device` comes from the `output_buses` config. None follows the device selected in the UI.
+    if device is None:
+        return SoundboardDeviceOutput(selected_device)
+    elif device == "dummy":
+        return SoundboardDummyOutput()
+    elif device.startswith("file:"):
+        return SoundboardFileOutput(os.path.expanduser(device[len("file:"):]))
+
+    for index, name in output_devices.items():
+        if name == device:
+            return SoundboardDeviceOutput(index)
+    raise SoundboardError(f'Output device "{device}" not found.')
+
+class SoundboardOutputBus(threading.Thread):
+    # Writes the blocks of one bus to its backend. `blocks` holds at most `max_drift_blocks`, which bounds how far apart buses can drift.
+
+    def __init__(self, master: SoundboardABC | None, name: str, backend: SoundboardOutputBackend, max_drift_blocks: int=2) -> None:
+        super().__init__(daemon=True)
+
+        self._stop_event = threading.Event()
+        self.master = master
+        self.name = name
+        self.backend = backend
+        self.blocks: queue.Queue[numpy.ndarray] = queue.Queue(maxsize=max_drift_blocks)
+        self.dropped_frames = 0
+
+    def stop(self):
+        self._stop_event.set()
+
+    def push(self, block: numpy.ndarray, wait: bool=False) -> None:
+        if wait:
+            while not self._stop_event.is_set() and self.is_alive():
+                try:
+                    return self.blocks.put(block, timeout=0.1)
+                except queue.Full:
+                    continue
+            return
+
+        # Buses that are not the clock skip ahead instead of falling further behind
+        while True:
+            try:
+                return self.blocks.put_nowait(block)
+            except queue.Full:
+                try:
+                    self.dropped_frames += len(self.blocks.get_nowait())
+                    logger.debug(f'Output bus "{self.name}" fell behind, dropped a block ({self.dropped_frames} frames total)')
+                except queue.Empty:
+                    pass
+
+    def run(self) -> None:
+        try:
+            self.backend.open(sample_rate, channel_count)
+            while not self._stop_event.is_set():
+                try:
+                    self.backend.write(self.blocks.get(timeout=0.1))
+                except queue.Empty:
+                    continue
+
+        except OSError as audio_error:
+            logger.error(f'Audio error on output bus "{self.name}": {audio_error}')
+            if self.master:
+                self.master.display_warning(f'Cannot play on output "{self.name}". Perhaps it was unplugged?')
+        
+        except Exception as error: # E.g. `wave.Error` from a file output
+            logger.error(f'Error on output bus "{self.name}": {error}')
+            if self.master:
+                self.master.display_warning(f'Output "{self.name}" stopped: {error}')
+        finally:
+            self.backend.close()
+
+class SoundboardRouter(threading.Thread):
+    # Renders every bus from the scheduler once per block and hands the blocks to the output buses.
+    # The first bus is the clock: rendering waits on it, so the other buses stay within its `max_drift_blocks`.
+
+    def __init__(self, master: SoundboardABC | None, scheduler: SoundboardScheduler, buses: list[SoundboardOutputBus]) -> None:
+        super().__init__(daemon=True)
+
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._replacing: set[str] = set()
+        self.master = master
+        self.scheduler = scheduler
+        self.buses = buses
+
+    def stop(self):
+        self._stop_event.set()
+        with self._lock:
+            for bus in self.buses:
+                bus.stop()
+
+    def replace_backend(self, name: str, backend: SoundboardOutputBackend) -> None:
+        # Only restarts the one bus, everything else keeps playing
+        with self._lock:
+            old_bus = next((bus for bus in self.buses if bus.name == name), None)
+            if old_bus is None:
+                return
+            self._replacing.add(name)
+        
+        try:
+            # The old bus closes its backend on the way out, it must release the device before the replacement opens it
+            old_bus.stop()
+            old_bus.join(timeout=1)
+            
+            new_bus = SoundboardOutputBus(old_bus.master, name, backend, old_bus.blocks.maxsize)
+            new_bus.start()
+            with self._lock:
+                self.buses[self.buses.index(old_bus)] = new_bus
+        finally:
+            with self._lock:
+                self._replacing.discard(name)
+    
+    def is_bus_alive(self, name: str) -> bool:
+        with self._lock:
+            return any(bus.name == name and bus.is_alive() for bus in self.buses)
+
+    def drift_frames(self) -> int:
+        with self._lock:
+            written = [bus.backend.frames_written + bus.dropped_frames for bus in self.buses]
+        return max(written) - min(written) if written else 0
+
+    def run(self) -> None:
+        for bus in self.buses:
+            bus.start()
+
+        while not self._stop_event.is_set():
+            with self._lock:
+                buses = list(self.buses)
+                clock_replacing = bool(buses) and buses[0].name in self._replacing
+            
+            if clock_replacing:
+                self._stop_event.wait(block_frames / self.scheduler.rate) # The clock is restarting, hold the audio clock until it is back
+                continue
+            if not buses or not buses[0].is_alive():
+                break # Nothing left to keep time with
+
+            blocks = self.scheduler.render(block_frames)
+            for i, bus in enumerate(buses):
+                if bus.name in blocks:
+                    bus.push(blocks[bus.name], wait=i == 0)
+
+        stopped_unexpectedly = not self._stop_event.is_set()
+        self.stop()
+        
+        if stopped_unexpectedly:
+            # Scheduled clips would never end, and would play late once the next trigger restarts the router
+            self.scheduler.stop_all()
+            if self.master:
+                self.master.after(0, self.master.stop_audio) # type: ignore
+
 class SoundboardRecordingThread(threading.Thread):
     def __init__(self, master: SoundboardABC, input_device_index: int | None=None) -> None:
         super().__init__()
         
         self._stop_event = threading.Event()
         self.master = master
-        self.audio: bytes = b''
+        self.audio: numpy.ndarray = numpy.zeros((0, 2), dtype=numpy.int16)
         self.port_audio: pyaudio.PyAudio = pyaudio.PyAudio()
-        self.hertz = 44100
+        self.hertz = sample_rate
         self.has_stopped = False
+        self.discarded = False
         self.device = input_device_index
+        self._accounted_bytes = 0
+        self._lock = threading.Lock()
         
     def stop(self):
         self._stop_event.set()
         self.has_stopped = True
+    
+    def _auto_stop(self, message: str) -> None:
+        self.stop()
+        self.master.after(0, lambda: self.master._set_recording_buttons_highlight(True)) # type: ignore
+        self.master.display_warning(message)
+    
+    def _set_audio(self, audio: numpy.ndarray) -> None:
+        # Accounting happens under the lock so a concurrent `discard` cannot leave bytes counted
+        with self._lock:
+            if self.discarded:
+                return
+            
+            self.master.memory.add("recordings", audio.nbytes - self._accounted_bytes)
+            self._accounted_bytes = audio.nbytes
+            self.audio = audio
         
     def run(self) -> None:
         
         try:
-            rec_stream = self.port_audio.open(rate=self.hertz, channels=1, format=pyaudio.paInt16, frames_per_buffer=1024, input=True, input_device_index=self.device)
-            frames = []
+            rec_stream = self.port_audio.open(rate=self.hertz, channels=1, format=pyaudio.paInt16, frames_per_buffer=block_frames, input=True, input_device_index=self.device)
+            
+            # Mono input is written straight into one stereo buffer, `self.audio` is a view of the recorded part.
+            # The buffer is zeroed lazily by the OS, so pages that are never recorded into are never allocated.
+            stereo = numpy.zeros((self.hertz * max_sound_seconds, 2), dtype=numpy.int16)
+            recorded = 0
             while not self._stop_event.is_set():
-                frames.append(rec_stream.read(1024))
+                if recorded + block_frames > len(stereo):
+                    self._auto_stop(f"Recording stopped, recordings cannot be longer than {max_sound_seconds} seconds.")
+                    break
+                if not self.master.clip_cache.make_room(block_frames * stereo.itemsize * 2):
+                    self._auto_stop("Recording stopped, memory budget reached.")
+                    break
+                
+                stereo[recorded:recorded + block_frames] = numpy.frombuffer(rec_stream.read(block_frames), dtype=numpy.int16)[:, numpy.newaxis]
+                recorded += block_frames
+                self._set_audio(stereo[:recorded])
             
             rec_stream.stop_stream()
             rec_stream.close()
             self.port_audio.terminate()
             
-            mono_audio = b''.join(frames)
-            mono_raw = numpy.frombuffer(mono_audio, dtype=numpy.int16)
-            stereo_audio_np = numpy.repeat(mono_raw[:, numpy.newaxis], 2, axis=1)
-            self.audio = stereo_audio_np.astype(numpy.int16).tobytes()
-            
-            if all(b == 0 for b in self.audio):
+            if not self.discarded and not self.audio.any():
                 self.master.display_warning("Audio is empty. Did you grant microphone permission from System Settings to this application?")
                 
         except OSError as audio_error:
@@ -225,6 +804,15 @@ class SoundboardRecordingThread(threading.Thread):
             wave_file.setsampwidth(self.port_audio.get_sample_size(pyaudio.paInt16))
             wave_file.setframerate(self.hertz)
             wave_file.writeframes(self.audio)
+    
+    def discard(self):
+        # Frees the recording. Safe to call while still recording
+        with self._lock:
+            self.discarded = True
+            self.master.memory.release("recordings", self._accounted_bytes)
+            self._accounted_bytes = 0
+            self.audio = numpy.zeros((0, 2), dtype=numpy.int16)
+        self.stop()
 
 class SoundboardKeyboardListenerThread(Listener):
     def __init__(self, master: SoundboardABC) -> None:
@@ -237,6 +825,8 @@ class SoundboardKeyboardListenerThread(Listener):
             HotKey(HotKey.parse(f'{base_keypress}+p'), lambda: self.master.listen_to_playback()), # type: ignore
             HotKey(HotKey.parse(f'{base_keypress}+s'), lambda: self.master.write_playback_as_file()), # type: ignore
             HotKey(HotKey.parse(f'{base_keypress}+q'), lambda: self.master.stop_audio()), # type: ignore
+            HotKey(HotKey.parse(f'{base_keypress}+e'), lambda: self.master.toggle_queue_mode()), # type: ignore
+            HotKey(HotKey.parse(f'{base_keypress}+m'), lambda: self.master.dump_memory_stats()), # type: ignore
             HotKey(HotKey.parse(f'{base_keypress}+0'), lambda: self.master.reload_sounds())
         ])
         
@@ -275,11 +865,11 @@ class SoundboardButton(tkmacosx.Button, tkinter.Button): # NOTE: Inheriting fro
         self.bind("<BackSpace>", self.on_elem_press_del)
     
     def on_elem_enter(self, event: tkinter.Event) -> None:
-        if not pygame.mixer.get_busy() and self.cget("background") == self.master_color:
+        if not self.owner_master.scheduler.is_busy() and self.cget("background") == self.master_color:
             self["background"] = default_highlight_color
     
     def on_elem_exit(self, event: tkinter.Event) -> None:
-        if not pygame.mixer.get_busy() and self.cget("background") == default_highlight_color:
+        if not self.owner_master.scheduler.is_busy() and self.cget("background") == default_highlight_color:
             self["background"] = self.master_color
 
     def on_elem_press_del(self, event: tkinter.Event) -> None:
@@ -323,10 +913,12 @@ class Soundboard(tkinter.Tk, SoundboardABC):
             self.recording_thread.stop()
         
         self.stop_audio()
+        self._stop_output()
+        self.clip_cache.clear()
         self.destroy()
         exit(0)
         
-    def _handle_audio_end(self, button_ref: pygame.mixer.SoundType, button: SoundboardButton | None):
+    def _handle_audio_end(self, button_ref: SoundboardClip, button: SoundboardButton | None):
         try:
             if button:
                 button.configure(background=button.master_color)
@@ -338,48 +930,73 @@ class Soundboard(tkinter.Tk, SoundboardABC):
         for button in self._sb_buttons:
             button.configure(background=button.master_color if color_name_or_hex == None else color_name_or_hex)
     
-    def play_sound(self, button: SoundboardButton | None, sound_file: str | bytes | int) -> None:
+    def _stop_output(self) -> None:
+        if isinstance(self.router, SoundboardRouter):
+            self.router.stop()
+            self.router = None
+    
+    def _ensure_output(self) -> None:
+        # Starts the router if it is not running. Otherwise only restarts buses that died (E.g. a virtual device disappeared)
+        # and, if the selected device changed, the buses that follow it.
+        selected_out = tuple(self.audio_select.curselection())
+        device = list(self.output_devices)[selected_out[0]] if selected_out and self.output_devices else None
+        max_drift_blocks = max(1, round(config.max_drift_ms / 1000 * sample_rate / block_frames))
+        
+        if not (self.router and self.router.is_alive()):
+            self._stop_output()
+            buses = [SoundboardOutputBus(self, name, create_output_backend(bus.get("device"), device, self.output_devices), max_drift_blocks) for name, bus in config.output_buses.items()]
+            self.router = SoundboardRouter(self, self.scheduler, buses)
+            self.router.start()
+            
+        else:
+            for name, bus in config.output_buses.items():
+                if (bus.get("device") is None and device != self._old_device) or not self.router.is_bus_alive(name):
+                    self.router.replace_backend(name, create_output_backend(bus.get("device"), device, self.output_devices))
+        
+        self._old_device = device
+    
+    def play_sound(self, button: SoundboardButton | None, sound_file: str | bytes | numpy.ndarray | int) -> None:
         try:
             
             if isinstance(sound_file, str):
-                new_sound = pygame.mixer.Sound(file=f"{sound_path}/{sound_file}")
+                new_sound = self.clip_cache.load(f"{sound_path}/{sound_file}")
             elif isinstance(sound_file, bytes):
-                new_sound = pygame.mixer.Sound(buffer=sound_file)
+                new_sound = numpy.frombuffer(sound_file, dtype=numpy.int16).reshape(-1, channel_count)
+            elif isinstance(sound_file, numpy.ndarray):
+                new_sound = sound_file
             elif isinstance(sound_file, int):
-                new_sound = pygame.mixer.Sound(file=f"{sound_path}/{self._sb_buttons[sound_file]["text"]}")
+                new_sound = self.clip_cache.load(f"{sound_path}/{self._sb_buttons[sound_file]["text"]}")
                 button = self._sb_buttons[sound_file]
             else:
-                raise TypeError(f"`sound_file` must be str (path), bytes (Raw PCM), or int (sound index)")
+                raise TypeError(f"`sound_file` must be str (path), bytes (Raw PCM), numpy.ndarray (PCM frames), or int (sound index)")
             
-            if new_sound.get_length() > 60:
-                return self.display_warning(f"Soundboard audio cannot be longer than 60 seconds.")
-            if len(self._playing_sounds) > max_sounds_at_once:
+            if len(new_sound) > max_sound_seconds * sample_rate:
+                return self.display_warning(f"Soundboard audio cannot be longer than {max_sound_seconds} seconds.")
+            if not self.queue_mode and len(self._playing_sounds) > max_sounds_at_once:
                 return self.display_warning(f"Cannot play more than {max_sounds_at_once} sounds.")
             
-            selected_out = tuple(self.audio_select.curselection())
-            device = self.audio_select.get(selected_out[0]) if selected_out else None
+            self._ensure_output()
+            
+            # Called from the router thread once the last frame of the clip has been rendered
+            on_end = lambda clip, button=button: self.after(0, lambda: self._handle_audio_end(clip, button))
+            name = sound_file if isinstance(sound_file, str) else button["text"] if button else "recording"
             
-            if device != self._old_device:
-                pygame.mixer.quit()
-                pygame.mixer.init(devicename=device)
+            routes = config.clip_routes.get(name, config.default_route)
             
-            self._old_device = device    
-            new_sound.set_volume(self.volume)
+            if self.queue_mode:
+                self._playing_sounds.append(self.scheduler.queue(name, new_sound, on_end=on_end, routes=routes))
+            elif config.quantize_triggers:
+                self._playing_sounds.append(self.scheduler.schedule(name, new_sound, self.scheduler.next_beat(), on_end=on_end, routes=routes))
+            else:
+                self._playing_sounds.append(self.scheduler.schedule(name, new_sound, on_end=on_end, routes=routes))
             
             if button:
                 button.configure(background="green")
-            self._playing_sounds.append(new_sound)
-            self._playing_sounds[-1].play()
-            
-            self.after(int(new_sound.get_length() * 1000), lambda: self._handle_audio_end(new_sound, button))
             
         except pygame.error as err:
             lowered_err = str(err).lower()
             
-            if lowered_err == "no such device.":
-                self.display_warning(f'Cannot play on selected audio output. Perhaps it was unplugged?')    
-                self.reload_sounds()
-            elif lowered_err.startswith("no file") == True:
+            if lowered_err.startswith("no file") == True:
                 self.display_warning(f'Cannot find file "{sound_file}"')
                 self.reload_sounds()    
             else:
@@ -389,20 +1006,17 @@ class Soundboard(tkinter.Tk, SoundboardABC):
         except FileNotFoundError:
             self.display_warning(f'Missing sound file: "{sound_file}"')
         
+        except SoundboardError as err:
+            self.display_warning(f"{err} (File: {sound_file})")
+        
         except IndexError:
             pass
         
         except Exception as err:
             logger.error(f"Error playing sound: {err} (File: {sound_file})")
             self.display_warning(f"Error playing sound: {err} (File: {sound_file})")
-            if pygame.mixer.get_init():
-                pygame.mixer.quit()
-                
-    def get_avalible_audio_devices(self) -> list[str]:
-        pygame.mixer.init()
-        return get_audio_device_names(False)
     
-    def get_avalible_input_devices(self) -> dict[int, str]:
+    def _get_avalible_devices(self, channel_key: str) -> dict[int, str]:
         
         port_audio = pyaudio.PyAudio()
         info = port_audio.get_host_api_info_by_index(0)                                         
@@ -411,35 +1025,60 @@ class Soundboard(tkinter.Tk, SoundboardABC):
         
         if isinstance(numdevices, int):
             for i in range(0, numdevices):
-                device_has_input = port_audio.get_device_info_by_index(i).get('maxInputChannels')
-                if isinstance(device_has_input, (int, float)) and device_has_input > 0:
+                device_has_channels = port_audio.get_device_info_by_index(i).get(channel_key)
+                if isinstance(device_has_channels, (int, float)) and device_has_channels > 0:
                     device_name = port_audio.get_device_info_by_index(i).get('name')
                     if device_name:
                         device_dict[i] = port_audio.get_device_info_by_index(i).get('name')
 
         port_audio.terminate()
         return device_dict
+    
+    def get_avalible_audio_devices(self) -> dict[int, str]:
+        return self._get_avalible_devices('maxOutputChannels')
+    
+    def get_avalible_input_devices(self) -> dict[int, str]:
+        return self._get_avalible_devices('maxInputChannels')
         
     def stop_audio(self) -> None:
-        # Stops any audio that is playing
+        # Stops any audio that is playing
+        self.scheduler.stop_all()
+        self._set_all_buttons_default()
+        self._playing_sounds.clear()
+    
+    def toggle_queue_mode(self) -> None:
+        # While on, new sounds are chained gaplessly after whatever is already scheduled
+        self.queue_mode = not self.queue_mode
+        self.queue_button.configure(text=f"Queue Mode: {"On" if self.queue_mode else "Off"}")
+    
+    def _discard_recording(self) -> None:
+        if isinstance(self.recording_thread, SoundboardRecordingThread):
+            self.recording_thread.discard()
+        self.recording_thread = None
+    
+    def update_memory_label(self) -> None:
+        # Refreshes the live memory usage every second
         try:
-            for sound in self._playing_sounds:
-                sound.stop()
-            
-            self._set_all_buttons_default()
-            self._playing_sounds.clear()
-            
-        except pygame.error as e:
-            logging.error(f"Mixer not init? ({e})")
+            self.memory_label.configure(text=f"Memory: {self.memory.used / bytes_per_mb:.0f} / {self.memory.budget / bytes_per_mb:.0f} MB")
+            self.after_id = self.after(1000, self.update_memory_label)
+        except tkinter.TclError: # Label was destroyed by a reload
+            pass
+    
+    def dump_memory_stats(self) -> None:
+        logger.info(self.memory.format_stats())
     
     def init(self):
-        self.recording_thread = None
+        self._discard_recording()
         self._sb_buttons.clear()
         self._playing_sounds.clear()
         
     def reload_sounds(self) -> None:
         # Re-renders all buttons
         self.stop_audio()
+        if self.after_id:
+            self.after_cancel(self.after_id)
+            self.after_id = None
+        
         self.grid_rowconfigure([row for row in range(config.buttons_per_row + 1)], weight=5)
         
         for button in self._sb_buttons:
@@ -464,8 +1103,7 @@ class Soundboard(tkinter.Tk, SoundboardABC):
     def set_volume(self, volume: int | float):
         self.volume = volume / 100
         
-        for sound in self._playing_sounds:
-            sound.set_volume(volume / 100)
+        self.scheduler.gain = self.volume
     
     def open_sound_folder(self):
         os.system(f"open --reveal {sound_path}/")
@@ -499,7 +1137,7 @@ class Soundboard(tkinter.Tk, SoundboardABC):
                 self.recording_thread.stop()
                 self._set_recording_buttons_highlight(True)
             else:
-                self.recording_thread = None
+                self._discard_recording()
                 self._set_recording_buttons_highlight(False)
                 
         else:
@@ -520,7 +1158,7 @@ class Soundboard(tkinter.Tk, SoundboardABC):
         self._set_recording_buttons_highlight(False)
         if isinstance(self.recording_thread, SoundboardRecordingThread):
             self.recording_thread.write_to_file(_get_recorded_name("recording"))
-            self.recording_thread = None
+            self._discard_recording()
             
             self.after(500, self.reload_sounds)
             
@@ -551,7 +1189,7 @@ class Soundboard(tkinter.Tk, SoundboardABC):
         column = next_free_column()
         sys_background = self.cget("bg")
         
-        audio_devices = self.get_avalible_audio_devices()
+        self.output_devices = self.get_avalible_audio_devices()
         self.input_devices = self.get_avalible_input_devices()
         
         common_scale_args = {
@@ -591,17 +1229,25 @@ class Soundboard(tkinter.Tk, SoundboardABC):
         show_sound_folder = SoundboardSystemButton(self, text="Open Sound Folder", command=self.open_sound_folder, activebackground="orange", **system_button_kwargs)
         show_sound_folder.grid(row=2, column=column, **self.common_system_button_kwargs)
         
-        self.device_label = tkinter.Label(self, text=f"Output Devices ({len(audio_devices)} Avalible)", **system_button_kwargs)
+        self.device_label = tkinter.Label(self, text=f"Output Devices ({len(self.output_devices)} Avalible)", **system_button_kwargs)
         self.device_label.grid(row=3, column=column, **self.common_system_button_kwargs)
         self.device_label.configure(**label_args)
         
         self.audio_select = tkinter.Listbox(self, selectmode=tkinter.BROWSE, **system_button_kwargs)
         self.audio_select.configure(**listbox_args)
         
-        for ao_i, audio in enumerate(audio_devices):
-            self.audio_select.insert(ao_i + 1, audio)
+        for ao_i, audio in enumerate(self.output_devices.items()):
+            self.audio_select.insert(ao_i + 1, audio[1])
         else:
             self.audio_select.grid(row=4, column=column, **self.common_system_button_kwargs)
+        
+        self.queue_button = SoundboardSystemButton(self, text=f"Queue Mode: {"On" if self.queue_mode else "Off"}", command=self.toggle_queue_mode, activebackground="light blue", **system_button_kwargs)
+        self.queue_button.grid(row=5, column=column, **self.common_system_button_kwargs)
+        
+        self.memory_label = tkinter.Label(self, **system_button_kwargs)
+        self.memory_label.grid(row=6, column=column, **self.common_system_button_kwargs)
+        self.memory_label.configure(**label_args)
+        self.update_memory_label()
             
         # Sliders (Scale) and Labels for sliders
         
@@ -700,8 +1346,34 @@ class Soundboard(tkinter.Tk, SoundboardABC):
             return path
         return self.display_error(f"Missing asset: {path}")
     
+def benchmark_memory_budget(clip_count: int=1000, clip_seconds: float=1.0, budget_mb: float=32, stream_threshold_mb: float=4) -> None:
+    # Stress benchmark. Loads `clip_count` generated clips (Every 100th one long enough to be streamed) through a clip cache with a fixed budget.
+    accountant = SoundboardMemoryAccountant(int(budget_mb * bytes_per_mb))
+    cache = SoundboardClipCache(accountant, int(stream_threshold_mb * bytes_per_mb))
+
+    with tempfile.TemporaryDirectory() as clip_directory:
+        for i in range(clip_count):
+            seconds = clip_seconds * 30 if i % 100 == 0 else clip_seconds
+            tone = (numpy.sin(numpy.arange(int(sample_rate * seconds)) * 2 * math.pi * (220 + i) / sample_rate) * 8000).astype(numpy.int16)
+            write_wave(f"{clip_directory}/clip-{i}.wav", numpy.repeat(tone[:, numpy.newaxis], channel_count, axis=1))
+
+        started_at = time.perf_counter()
+        for i in range(clip_count):
+            cache.load(f"{clip_directory}/clip-{i}.wav")
+        elapsed = time.perf_counter() - started_at
+
+        print(f"Loaded {clip_count} clips in {elapsed:.2f}s ({elapsed / clip_count * 1000:.2f}ms per clip)")
+        print(accountant.format_stats())
+        print(f"Peak within budget: {accountant.peak <= accountant.budget}")
+        cache.clear()
+
 if __name__ == "__main__":
+    import sys
     from platform import platform
     sys_platform = platform().startswith("macOS")
+    
+    if "--benchmark-memory" in sys.argv:
+        benchmark_memory_budget()
+        exit(0)
         
     Soundboard().mainloop()
\ No newline at end of file
@@ -0,0 +1,51 @@
+import os, sys, tempfile
+
+# Soundboard.py creates its config folder and log file in ~/.config on import, keep that out of the real home folder.
+os.environ["HOME"] = tempfile.mkdtemp(prefix="soundboard-tests-")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy, pytest
+
+from typing import Callable
+from Soundboard import SoundboardMemoryAccountant, SoundboardClipCache, write_wave, bytes_per_mb, sample_rate, channel_count
+
+class FakeMaster:
+    # Stands in for `Soundboard` in threads that call back into the app
+    def __init__(self, budget: int=10 * bytes_per_mb) -> None:
+        self.memory = SoundboardMemoryAccountant(budget)
+        self.clip_cache = SoundboardClipCache(self.memory, budget)
+        self.warnings: list[str] = []
+        self.recording_highlight: list[bool] = []
+        self.audio_stopped = False
+    
+    def after(self, ms: int, func: Callable) -> None:
+        func()
+    
+    def display_warning(self, message: str) -> None:
+        self.warnings.append(message)
+    
+    def stop_audio(self) -> None:
+        self.audio_stopped = True
+    
+    def _set_recording_buttons_highlight(self, on_off: bool) -> None:
+        self.recording_highlight.append(on_off)
+
+@pytest.fixture
+def make_clip() -> Callable[[int, int], numpy.ndarray]:
+    def _make_clip(frames: int, value: int) -> numpy.ndarray:
+        return numpy.full((frames, channel_count), value, dtype=numpy.int16)
+    return _make_clip
+
+@pytest.fixture
+def write_clip(tmp_path, make_clip) -> Callable[..., str]:
+    # Writes a constant clip of `seconds` into the test's temp folder and returns its path
+    def _write_clip(name: str, seconds: float, value: int=1000) -> str:
+        path = f"{tmp_path}/{name}.wav"
+        write_wave(path, make_clip(int(sample_rate * seconds), value))
+        return path
+    return _write_clip
+
+@pytest.fixture
+def fake_master() -> FakeMaster:
+    return FakeMaster()
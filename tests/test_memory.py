@@ -0,0 +1,124 @@
+import os, numpy, pytest
+
+from Soundboard import SoundboardMemoryAccountant, SoundboardClipCache, SoundboardRecordingThread, SoundboardError, block_frames, sample_rate, channel_count, max_sound_seconds, cache_path
+
+def clip_bytes(seconds: float) -> int:
+    return int(sample_rate * seconds) * channel_count * 2
+
+class FakeInput:
+    # Microphone that stops the recording after `blocks` reads
+    def __init__(self, recording: SoundboardRecordingThread, blocks: int) -> None:
+        self.recording = recording
+        self.blocks = blocks
+    
+    def open(self, **kwargs) -> "FakeInput":
+        return self
+    
+    def read(self, frames: int) -> bytes:
+        self.blocks -= 1
+        if self.blocks == 0:
+            self.recording.stop()
+        return numpy.full(frames, 500, dtype=numpy.int16).tobytes()
+    
+    def stop_stream(self) -> None:
+        pass
+    
+    def close(self) -> None:
+        pass
+    
+    def terminate(self) -> None:
+        pass
+
+def test_cache_evicts_least_recently_played(write_clip):
+    accountant = SoundboardMemoryAccountant(clip_bytes(1) * 2)
+    cache = SoundboardClipCache(accountant, clip_bytes(10))
+    first, second, third = (write_clip(name, 1) for name in ("first", "second", "third"))
+    
+    cache.load(first)
+    cache.load(second)
+    cache.load(first) # `second` is now the least recently played
+    cache.load(third)
+    
+    assert accountant.usage()["clips"] == clip_bytes(1) * 2
+    assert accountant.peak <= accountant.budget
+    assert cache.load(first) is cache.load(first)
+    assert second not in cache._clips
+
+def test_cache_keeps_playing_clips(write_clip):
+    accountant = SoundboardMemoryAccountant(clip_bytes(1))
+    playing = []
+    cache = SoundboardClipCache(accountant, clip_bytes(10), is_pinned=lambda pcm: any(pcm is clip for clip in playing))
+    
+    playing.append(cache.load(write_clip("playing", 1)))
+    streamed = cache.load(write_clip("next", 1)) # No room without evicting the playing clip
+    
+    assert isinstance(streamed, numpy.memmap)
+    assert accountant.usage()["clips"] == clip_bytes(1)
+    cache.clear()
+
+def test_cache_streams_large_clips(write_clip):
+    accountant = SoundboardMemoryAccountant(clip_bytes(10))
+    cache = SoundboardClipCache(accountant, clip_bytes(1))
+    
+    pcm = cache.load(write_clip("large", 2, value=1234))
+    assert isinstance(pcm, numpy.memmap)
+    assert (pcm == 1234).all()
+    assert accountant.used == 0
+    assert accountant.usage()["streamed"] == clip_bytes(2)
+    
+    cache.clear()
+    assert accountant.usage()["streamed"] == 0
+
+def test_cache_rejects_clips_over_the_limit(write_clip):
+    accountant = SoundboardMemoryAccountant(clip_bytes(max_sound_seconds * 2))
+    cache = SoundboardClipCache(accountant, clip_bytes(1))
+    spill_files = set(os.listdir(cache_path)) if os.path.exists(cache_path) else set()
+    
+    with pytest.raises(SoundboardError):
+        cache.load(write_clip("long", max_sound_seconds + 1))
+    
+    assert not any(accountant.usage().values())
+    assert (set(os.listdir(cache_path)) if os.path.exists(cache_path) else set()) == spill_files
+
+def test_recording_discard_releases_memory(fake_master):
+    recording = SoundboardRecordingThread(fake_master) # type: ignore
+    
+    recording._set_audio(numpy.zeros((sample_rate, channel_count), dtype=numpy.int16))
+    recording._set_audio(numpy.zeros((sample_rate * 2, channel_count), dtype=numpy.int16))
+    assert fake_master.memory.usage()["recordings"] == clip_bytes(2)
+    
+    recording.discard()
+    recording._set_audio(numpy.zeros((sample_rate * 3, channel_count), dtype=numpy.int16)) # Worker finishing after the discard
+    assert fake_master.memory.usage()["recordings"] == 0
+    assert len(recording.audio) == 0
+    recording.port_audio.terminate()
+
+def test_recording_evicts_clips_from_a_full_cache(fake_master, write_clip):
+    fake_master.memory.budget = clip_bytes(1) * 2
+    for name in ("first", "second"):
+        fake_master.clip_cache.load(write_clip(name, 1))
+    assert not fake_master.memory.fits(block_frames * channel_count * 2)
+    
+    recording = SoundboardRecordingThread(fake_master) # type: ignore
+    recording.port_audio.terminate()
+    recording.port_audio = FakeInput(recording, blocks=10) # type: ignore
+    recording.run()
+    
+    assert not fake_master.warnings
+    assert len(recording.audio) == block_frames * 10
+    assert (recording.audio == 500).all()
+    assert fake_master.memory.usage()["recordings"] == recording.audio.nbytes
+    assert fake_master.memory.used <= fake_master.memory.budget
+
+def test_recording_stops_when_nothing_can_be_evicted(fake_master):
+    fake_master.memory.budget = block_frames * channel_count * 2 * 3
+    
+    recording = SoundboardRecordingThread(fake_master) # type: ignore
+    recording.port_audio.terminate()
+    recording.port_audio = FakeInput(recording, blocks=10) # type: ignore
+    recording.run()
+    
+    assert len(recording.audio) == block_frames * 3
+    assert recording.has_stopped
+    assert fake_master.recording_highlight == [True]
+    assert fake_master.warnings == ["Recording stopped, memory budget reached."]
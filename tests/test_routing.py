@@ -0,0 +1,169 @@
+import time, wave, dataclasses, numpy, pytest
+
+import Soundboard
+from Soundboard import SoundboardScheduler, SoundboardRouter, SoundboardOutputBus, SoundboardDummyOutput, SoundboardFileOutput, SoundboardError, create_output_backend, validate_routes, block_frames, sample_rate
+
+def wait_until_idle(scheduler: SoundboardScheduler, timeout: float=2) -> None:
+    deadline = time.perf_counter() + timeout
+    while scheduler.is_busy() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+class SlowOutput(SoundboardDummyOutput):
+    # Consumes at half speed, like a device whose clock is far behind
+    def write(self, block: numpy.ndarray) -> None:
+        time.sleep(len(block) / sample_rate * 2)
+        self.frames_written += len(block)
+
+class BrokenOutput(SoundboardDummyOutput):
+    def open(self, rate: int, channels: int) -> None:
+        raise OSError("Device unplugged")
+
+class LoggedOutput(SoundboardDummyOutput):
+    def __init__(self, name: str, events: list[str]) -> None:
+        super().__init__()
+        self.name = name
+        self.events = events
+    
+    def open(self, rate: int, channels: int) -> None:
+        super().open(rate, channels)
+        self.events.append(f"open {self.name}")
+    
+    def close(self) -> None:
+        time.sleep(0.05) # Like a device that takes a moment to release
+        self.events.append(f"close {self.name}")
+
+class WaveErrorOutput(SoundboardDummyOutput):
+    def write(self, block: numpy.ndarray) -> None:
+        raise wave.Error("Disk full")
+
+def test_offline_render_applies_route_and_bus_gain(make_clip):
+    scheduler = SoundboardScheduler(buses={"main": 1.0, "stream": 0.5})
+    clip = make_clip(5000, 1000)
+    scheduled = scheduler.schedule("a", clip, 100, routes={"main": 1.0, "stream": 0.5})
+    
+    out = scheduler.render_offline(6000)
+    assert numpy.shares_memory(scheduled.pcm, clip)
+    assert out["main"][99, 0] == 0
+    assert (out["main"][100:5100] == 1000).all()
+    assert (out["stream"][100:5100] == 250).all()
+    assert (out["stream"][5100:] == 0).all()
+
+def test_clip_only_reaches_its_buses(make_clip):
+    scheduler = SoundboardScheduler(buses={"main": 1.0, "stream": 1.0})
+    scheduler.schedule("a", make_clip(100, 1000), routes={"stream": 1.0})
+    
+    out = scheduler.render_offline(200)
+    assert not out["main"].any()
+    assert (out["stream"][:100] == 1000).all()
+
+def test_router_sends_the_same_audio_to_every_bus(make_clip):
+    scheduler = SoundboardScheduler(buses={"main": 1.0, "stream": 0.5})
+    scheduler.schedule("a", make_clip(4096, 1000), 0, routes={"main": 1.0, "stream": 0.5})
+    main, stream = SoundboardDummyOutput(capture=True), SoundboardDummyOutput(realtime=False, capture=True)
+    
+    router = SoundboardRouter(None, scheduler, [SoundboardOutputBus(None, "main", main), SoundboardOutputBus(None, "stream", stream)])
+    router.start()
+    wait_until_idle(scheduler)
+    time.sleep(0.1)
+    router.stop()
+    router.join(1)
+    
+    main_audio, stream_audio = numpy.concatenate(main.blocks), numpy.concatenate(stream.blocks)
+    frames = min(len(main_audio), len(stream_audio))
+    assert frames >= 4096
+    assert (main_audio[:4096] == 1000).all()
+    assert (main_audio[4096:frames] == 0).all()
+    assert (stream_audio[:frames] * 4 == main_audio[:frames]).all()
+
+def test_router_bounds_drift_of_slow_bus():
+    scheduler = SoundboardScheduler(buses={"main": 1.0, "stream": 1.0})
+    max_drift_blocks = 2
+    slow = SlowOutput()
+    
+    router = SoundboardRouter(None, scheduler, [SoundboardOutputBus(None, "main", SoundboardDummyOutput(), max_drift_blocks), SoundboardOutputBus(None, "stream", slow, max_drift_blocks)])
+    router.start()
+    
+    for _ in range(20):
+        time.sleep(0.02)
+        assert router.drift_frames() <= (max_drift_blocks + 2) * block_frames
+    
+    router.stop()
+    router.join(1)
+    assert router.buses[1].dropped_frames > 0
+
+def test_router_cleans_up_when_clock_bus_dies(make_clip, fake_master):
+    scheduler = SoundboardScheduler()
+    scheduler.schedule("a", make_clip(sample_rate, 1000))
+    
+    router = SoundboardRouter(fake_master, scheduler, [SoundboardOutputBus(fake_master, "main", BrokenOutput())]) # type: ignore
+    router.start()
+    router.join(1)
+    
+    assert not router.is_alive()
+    assert not scheduler.is_busy()
+    assert fake_master.audio_stopped
+    assert fake_master.warnings
+
+def test_replace_backend_releases_the_old_backend_first():
+    scheduler = SoundboardScheduler()
+    events: list[str] = []
+    
+    router = SoundboardRouter(None, scheduler, [SoundboardOutputBus(None, "main", LoggedOutput("old", events))])
+    router.start()
+    time.sleep(0.05)
+    router.replace_backend("main", LoggedOutput("new", events))
+    time.sleep(0.05)
+    
+    assert router.is_alive()
+    assert events == ["open old", "close old", "open new"]
+    router.stop()
+    router.join(1)
+
+def test_dead_secondary_bus_warns_and_can_be_restarted(fake_master):
+    scheduler = SoundboardScheduler(buses={"main": 1.0, "stream": 1.0})
+    
+    router = SoundboardRouter(fake_master, scheduler, [SoundboardOutputBus(fake_master, "main", SoundboardDummyOutput()), SoundboardOutputBus(fake_master, "stream", WaveErrorOutput())]) # type: ignore
+    router.start()
+    time.sleep(0.1)
+    
+    assert router.is_alive()
+    assert not router.is_bus_alive("stream")
+    assert fake_master.warnings
+    
+    stream = SoundboardDummyOutput(realtime=False, capture=True)
+    router.replace_backend("stream", stream)
+    time.sleep(0.1)
+    assert router.is_bus_alive("stream")
+    assert stream.blocks
+    
+    router.stop()
+    router.join(1)
+
+def test_file_output(tmp_path, make_clip):
+    scheduler = SoundboardScheduler()
+    scheduler.schedule("a", make_clip(2048, 1000), 0)
+    output = SoundboardFileOutput(str(tmp_path / "stream.wav"), realtime=False)
+    
+    router = SoundboardRouter(None, scheduler, [SoundboardOutputBus(None, "main", output)])
+    router.start()
+    wait_until_idle(scheduler)
+    router.stop()
+    router.join(1)
+    router.buses[0].join(1) # Closes the file
+    
+    with wave.open(str(tmp_path / "stream.wav")) as wave_file:
+        audio = numpy.frombuffer(wave_file.readframes(2048), dtype=numpy.int16)
+    assert (audio == 1000).all()
+
+def test_create_output_backend(tmp_path):
+    assert isinstance(create_output_backend("dummy", None, {}), SoundboardDummyOutput)
+    assert isinstance(create_output_backend(f"file:{tmp_path}/out.wav", None, {}), SoundboardFileOutput)
+    with pytest.raises(SoundboardError):
+        create_output_backend("Missing Device", None, {0: "Speakers"})
+
+def test_validate_routes():
+    validate_routes(Soundboard.config)
+    with pytest.raises(SoundboardError):
+        validate_routes(dataclasses.replace(Soundboard.config, clip_routes={"airhorn.wav": {"mian": 1.0}}))
+    with pytest.raises(SoundboardError):
+        validate_routes(dataclasses.replace(Soundboard.config, default_route={"stream": 1.0}))
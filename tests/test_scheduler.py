@@ -0,0 +1,100 @@
+import wave, numpy, pytest
+
+from Soundboard import SoundboardScheduler, SoundboardError, decode_sound, write_wave, block_frames, sample_rate, channel_count
+
+def test_queue_chains_without_gap(make_clip):
+    scheduler = SoundboardScheduler()
+    scheduler.queue("a", make_clip(1000, 100))
+    scheduler.queue("b", make_clip(1500, 200))
+    
+    out = scheduler.render_offline(3000)["main"]
+    assert (out[:1000] == 100).all()
+    assert (out[1000:2500] == 200).all()
+    assert (out[2500:] == 0).all()
+
+def test_sequence_start_frames(make_clip):
+    scheduler = SoundboardScheduler()
+    clips = scheduler.sequence([("a", make_clip(1000, 100)), ("b", make_clip(1500, 200))], start_frame=50)
+    assert [clip.start_frame for clip in clips] == [50, 1050]
+    
+    out = scheduler.render_offline(3000)["main"]
+    assert out[49, 0] == 0
+    assert out[50, 0] == 100
+    assert out[1049, 0] == 100
+    assert out[1050, 0] == 200
+    assert out[2549, 0] == 200
+    assert out[2550, 0] == 0
+    
+    # A clip that is already playing must not push the rest of the sequence back
+    scheduler = SoundboardScheduler()
+    scheduler.schedule("playing", make_clip(10000, 1), 0)
+    clips = scheduler.sequence([("a", make_clip(1000, 100)), ("b", make_clip(1000, 200))], start_frame=50)
+    assert [clip.start_frame for clip in clips] == [50, 1050]
+    
+    out = scheduler.render_offline(3000)["main"]
+    assert (out[50:1050] == 101).all()
+    assert (out[1050:2050] == 201).all()
+
+def test_next_beat_placement():
+    scheduler = SoundboardScheduler(bpm=120) # 22050 frames per beat
+    assert scheduler.next_beat(0) == 0
+    assert scheduler.next_beat(1) == 22050
+    assert scheduler.next_beat(22050) == 22050
+    
+    scheduler = SoundboardScheduler(bpm=128) # 20671.875 frames per beat
+    assert scheduler.next_beat(20671) == 20672
+    assert scheduler.next_beat(20672) == 20672
+    assert scheduler.next_beat(20673) == 41344
+
+def test_quantized_clip_starts_on_beat(make_clip):
+    scheduler = SoundboardScheduler(bpm=120)
+    scheduler.render_offline(700)
+    clip = scheduler.schedule("a", make_clip(1000, 100), scheduler.next_beat())
+    assert clip.start_frame == 22050
+    
+    out = scheduler.render_offline(23000)["main"]
+    assert out[22050 - 700 - 1, 0] == 0
+    assert (out[22050 - 700:22050 - 700 + 1000] == 100).all()
+
+def test_late_schedule_starts_now(make_clip):
+    scheduler = SoundboardScheduler()
+    scheduler.render_offline(500)
+    clip = scheduler.schedule("a", make_clip(100, 100), 100)
+    assert clip.start_frame == 500
+    
+    out = scheduler.render_offline(200)["main"]
+    assert (out[:100] == 100).all()
+    assert (out[100:] == 0).all()
+
+def test_on_end_fires_in_last_block(make_clip):
+    scheduler = SoundboardScheduler()
+    ended = []
+    boundary = scheduler.schedule("a", make_clip(block_frames, 100), 0, on_end=lambda clip: ended.append((clip.name, scheduler.frame)))
+    scheduler.schedule("b", make_clip(block_frames + 1, 100), 0, on_end=lambda clip: ended.append((clip.name, scheduler.frame)))
+    
+    scheduler.render(block_frames)
+    assert ended == [("a", block_frames)]
+    assert boundary.end_frame == block_frames
+    
+    scheduler.render(block_frames)
+    assert ended == [("a", block_frames), ("b", block_frames * 2)]
+    assert not scheduler.is_busy()
+
+def test_schedule_rejects_wrong_shape():
+    with pytest.raises(SoundboardError):
+        SoundboardScheduler().schedule("mono", numpy.zeros(100, dtype=numpy.int16))
+
+def test_write_to_file(tmp_path, make_clip):
+    scheduler = SoundboardScheduler()
+    scheduler.schedule("a", make_clip(1000, 100))
+    scheduler.write_to_file(str(tmp_path / "render.wav"), 3000)
+    
+    with wave.open(str(tmp_path / "render.wav")) as wave_file:
+        assert wave_file.getnframes() == 3000
+        assert wave_file.getframerate() == sample_rate
+
+def test_decode_without_audio_hardware(tmp_path):
+    pcm = numpy.arange(2000, dtype=numpy.int16).reshape(-1, channel_count)
+    write_wave(str(tmp_path / "clip.wav"), pcm)
+    
+    assert (decode_sound(str(tmp_path / "clip.wav")) == pcm).all()